@@ -3,10 +3,128 @@ import sys
 import os
 import subprocess
 import weakref
+import atexit
+import re
+import time
+import threading
+import collections
 from datetime import datetime
 from pathlib import Path
 
+# in case we are re-sourcing the file, write out the pending entries and release
+# the descriptor of the previous load before its state is replaced below
+_PREV_CLOSE = globals().get('_close_log_fd')
+if _PREV_CLOSE is not None:
+    _PREV_CLOSE()
+
 logFile = "stdout"
+# interned so the per-hit check against it is as cheap as possible
+_NONE = sys.intern("none")
+
+# strips newlines out of captured expression outputs
+_NL_TRANS = str.maketrans('', '', '\n\r')
+
+# keep the log file open between log entries instead of reopening it on every hit,
+# as a raw descriptor since entries are already batched below
+_logFd = None
+_logFdPath = None
+
+# log entries are batched in memory and written once the buffer is full or
+# a second has passed since the last write, when the inferior stops or exits
+# and before GDB shows its prompt. Not on cont, GDB also emits it when resuming
+# after every log hit
+_logBuf = bytearray()
+_LOG_BUF_MAX = 64 * 1024
+_LOG_FLUSH_INTERVAL = 1.0
+_lastFlush = time.monotonic()
+
+# optionally, full buffers are handed to a background thread that writes them,
+# so the inferior is not held back by the write. The thread never calls into
+# GDB, it only touches _queue, _writer_event and _logFd
+logFileAsync = False
+# a drainer thread from a previous load keeps waiting on these, so reuse them
+_queue = globals().get('_queue', collections.deque())
+_writer_event = globals().get('_writer_event', threading.Event())
+_logFdLock = globals().get('_logFdLock', threading.Lock())
+_drainer = globals().get('_drainer')
+_drainError = None
+
+def _write_all(fd, data):
+    # O_APPEND keeps each write atomic, loop in case of a short write
+    written = os.write(fd, data)
+    while written < len(data):
+        written += os.write(fd, data[written:])
+
+def _drain_queue():
+    with _logFdLock:
+        while _queue:
+            _write_all(_logFd, _queue.popleft())
+
+def _drain_loop():
+    global _drainError
+    while True:
+        _writer_event.wait()
+        _writer_event.clear()
+        try:
+            _drain_queue()
+        except Exception as e:
+            # keep draining, the error is reported from GDB's own thread
+            _drainError = e
+
+def _start_drainer():
+    global _drainer
+    if (_drainer is None) or (not _drainer.is_alive()):
+        _drainer = threading.Thread(target=_drain_loop, name="dlog-drainer", daemon=True)
+        _drainer.start()
+
+def _flush_log_buf(*args):
+    global _drainError, _lastFlush
+    _lastFlush = time.monotonic()
+    if _drainError is not None:
+        gdb.write("Log file write failed: {}\n".format(_drainError))
+        _drainError = None
+    if _logBuf and _logFd is not None:
+        if logFileAsync:
+            _queue.append(bytes(_logBuf))
+            _writer_event.set()
+        else:
+            _write_all(_logFd, _logBuf)
+    del _logBuf[:]
+
+def _close_log_fd():
+    global _logFd, _logFdPath
+    _flush_log_buf()
+    # whatever the drainer did not get to yet still belongs to this file
+    _drain_queue()
+    with _logFdLock:
+        if _logFd is not None:
+            os.close(_logFd)
+        _logFd = None
+        _logFdPath = None
+
+def _get_log_fd(path):
+    global _logFd, _logFdPath
+    if _logFdPath != path:
+        _close_log_fd()
+        with _logFdLock:
+            _logFd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+            _logFdPath = path
+    return _logFd
+
+# the handlers look up the helpers by name when called, so they are only
+# connected on the first load and keep using the latest definitions
+def _on_exit():
+    _close_log_fd()
+
+def _on_flush_event(*args):
+    _flush_log_buf()
+
+if not globals().get('_handlersConnected'):
+    atexit.register(_on_exit)
+    gdb.events.stop.connect(_on_flush_event)
+    gdb.events.exited.connect(_on_flush_event)
+    gdb.events.before_prompt.connect(_on_flush_event)
+    _handlersConnected = True
 
 class LogFile(gdb.Command):
     """Print or set target file to store log entries. It is possible to set to stdout"""
@@ -19,13 +137,35 @@ class LogFile(gdb.Command):
             gdb.write('Log file name is {}'.format(logFile))
             return
         if (arg == "stdout") or (arg == "none"):
-            logFile = arg
+            # interned so Log.stop can check for "none" by identity
+            logFile = sys.intern(arg)
         else:
-            Path(logFile).touch(mode=0o666, exist_ok=True)
+            Path(arg).touch(mode=0o666, exist_ok=True)
             logFile = arg
+        # next log entry reopens against the new target
+        _close_log_fd()
         gdb.write('Log file name set to {}'.format(logFile))
 
-LogFile()
+class LogFileAsync(gdb.Command):
+    """Print or set (on/off) whether log entries are written to the log file from a background thread"""
+    def __init__(self):
+        super(LogFileAsync, self).__init__("logfileasync", gdb.COMMAND_USER)
+
+    def invoke(self, arg, from_tty):
+        global logFileAsync
+        if not arg:
+            gdb.write('Log file async is {}'.format("on" if logFileAsync else "off"))
+            return
+        if arg == "on":
+            _start_drainer()
+            logFileAsync = True
+        elif arg == "off":
+            logFileAsync = False
+            # write out anything still queued
+            _drain_queue()
+        else:
+            raise Exception("Argument must be on or off")
+        gdb.write('Log file async set to {}'.format(arg))
 
 class GetThreadName(gdb.Command):
     """Print the current thead name, if none is set, then the thread id"""
@@ -48,7 +188,17 @@ class GetThreadName(gdb.Command):
         else:
             gdb.write('<unknown>')
 
-GetThreadName()
+# pointer width does not change during a session
+_HEX_FMT = '{0:#018x}' if sys.maxsize > 2**32 else '{0:#010x}'
+
+_basename_cache = {}
+
+def _bn(p):
+    r = _basename_cache.get(p)
+    if r is None:
+        r = os.path.basename(p)
+        _basename_cache[p] = r
+    return r
 
 def frameToString(frame):
     if (frame is None) or (not frame.is_valid()):
@@ -56,14 +206,15 @@ def frameToString(frame):
     locSpec = ''
     func = frame.function()
     if func is None:
-        hexSize = 8 if sys.maxsize > 2**32 else 4
-        locSpec = '{0:#0{1}x}'.format(frame.pc(), hexSize + 2)
+        locSpec = _HEX_FMT.format(frame.pc())
     else:
         sl = frame.find_sal()
-        if sl is None:
-            locSpec = os.path.basename(sl.symtab.filename)
+        if (sl is None) or (sl.symtab is None):
+            locSpec = _HEX_FMT.format(frame.pc())
+        elif not sl.line:
+            locSpec = _bn(sl.symtab.filename)
         else:
-            locSpec = '{}:{}'.format(os.path.basename(sl.symtab.filename), str(sl.line))
+            locSpec = '{}:{}'.format(_bn(sl.symtab.filename), str(sl.line))
     return locSpec
 
 class GetLocSpec(gdb.Command):
@@ -78,8 +229,6 @@ class GetLocSpec(gdb.Command):
         locSpec = frameToString(frame)
         gdb.write(locSpec)
 
-GetLocSpec()
-
 class GetSimpleBt(gdb.Command):
     """Print the simplified backtrace, just file base names"""
     def __init__(self):
@@ -92,13 +241,14 @@ class GetSimpleBt(gdb.Command):
         if (frame is None) or (not frame.is_valid()):
             gdb.write('<unknown>')
             return
-        simpleBt = ''
+        parts = []
+        append = parts.append
+        _f2s = frameToString
         while not (frame is None):
-            simpleBt += frameToString(frame) + ';'
+            append(_f2s(frame))
+            append(';')
             frame = frame.older()
-        gdb.write(simpleBt)
-
-GetSimpleBt()
+        gdb.write(''.join(parts))
 
 class GetFormatTime(gdb.Command):
     """Print the current timestamp using a custom format as defined by the strftime routine, pass the desired format as argument"""
@@ -108,9 +258,12 @@ class GetFormatTime(gdb.Command):
     def invoke(self, arg, from_tty):
         if not arg:
             raise Exception("This command requires one argument")
-        gdb.write(datetime.now().strftime(arg))
-
-GetFormatTime()
+        # time.strftime is cheaper, but only datetime supports microseconds, and
+        # datetime.now() is naive so %z and %Z have to keep printing nothing
+        if ('%f' in arg) or ('%z' in arg) or ('%Z' in arg):
+            gdb.write(datetime.now().strftime(arg))
+        else:
+            gdb.write(time.strftime(arg, time.localtime()))
 
 class SubprocExec(gdb.Command):
     """Execute command in subprocess and capture output, built-in GDB shell does not capture the output when running on python"""
@@ -120,54 +273,140 @@ class SubprocExec(gdb.Command):
     def invoke(self, arg, from_tty):        
         gdb.write(subprocess.check_output(gdb.string_to_argv(arg)).decode())
 
-SubprocExec()
+def _evalPrint(expr, _parseAndEval=gdb.parse_and_eval):
+    return str(_parseAndEval(expr))
+
+def _evalExec(expr, _execute=gdb.execute):
+    return _execute(expr, False, True)
+
+def _evalExpr(fn, expr):
+    # output of a compiled log expression, without newlines
+    return fn(expr).translate(_NL_TRANS)
+
+# the Log class of a previous load, if the file is being re-sourced
+_PREV = globals().get('Log')
+_PREV_INSTANCES = getattr(_PREV, 'instances', None) if _PREV is not None else None
 
 class Log(gdb.Breakpoint):
     """
     Python Breakpoint extension for "tracepoints", breakpoints that do not stop the inferior
     """
+    # plain "print EXPR" / "p EXPR" (no /FMT or -options) can be evaluated
+    # directly, without going through the CLI and capturing its output
+    printExprRegex = re.compile(r'^\s*(?:print|p)\s+([^-\s].*)$')
+
     @staticmethod
-    def generateLog(mess, exprs):
-        out = []
+    def compileExprs(exprs):
+        evalExprs = []
         for expr in exprs:
-            out.append(gdb.execute(expr, False, True))
-        outStr = mess.format(*out).replace('\n', '')
+            match = Log.printExprRegex.match(expr)
+            if match:
+                # bind the evaluator now, only the source text is parsed per hit
+                evalExprs.append((_evalPrint, match.group(1)))
+            else:
+                # x, backtrace, info, user commands... go through the CLI
+                evalExprs.append((_evalExec, expr))
+        return evalExprs
+
+    @staticmethod
+    def splitMessage(mess):
+        # literal segments around the {} placeholders
+        return mess.translate(_NL_TRANS).split('{}')
+
+    @staticmethod
+    def compileMessage(mess, exprs):
+        # derived fields, can be shared by all the logs defined with the same message
+        messParts = Log.splitMessage(mess)
+        return (messParts, [p.encode() for p in messParts], Log.compileExprs(exprs))
+
+    @staticmethod
+    def generateLog(messParts, evalExprs):
+        out = []
+        for part, (fn, expr) in zip(messParts, evalExprs):
+            out.append(part)
+            out.append(_evalExpr(fn, expr))
+        out.append(messParts[-1])
+        outStr = ''.join(out)
         return outStr
 
+    @staticmethod
+    def appendLog(buf, messPartsB, evalExprs):
+        # same as generateLog, but the message parts are already encoded and the
+        # entry goes straight into the log buffer, newline included
+        start = len(buf)
+        try:
+            for partB, (fn, expr) in zip(messPartsB, evalExprs):
+                buf += partB
+                buf += _evalExpr(fn, expr).encode()
+        except Exception:
+            # do not leave a partial entry behind
+            del buf[start:]
+            raise
+        buf += messPartsB[-1]
+        buf += b'\n'
+
     """
     A breakpoint that does not stop the inferior and outputs a user-defined message to a file
     """
-    def initInstances():
-        # restore all definitions in case we are re-sourcing the file
-        if Log.instances is not None:
-            return Log.instances
-        return []
+    # restore all definitions in case we are re-sourcing the file
+    instances = _PREV_INSTANCES if _PREV_INSTANCES is not None else []
+
+    @classmethod
+    def _on_dead(cls, ref):
+        # keep the instances list free of collected logs
+        try:
+            cls.instances.remove(ref)
+        except ValueError:
+            pass
 
-    instances = initInstances()
     def __init__(self, spec, **kwargs):
         """
         The underlying breakpoint is always internal
         """
         kwargs['internal'] = True
         super(Log, self).__init__(spec, **kwargs)
-        self.__class__.instances.append(weakref.proxy(self))
+        self.__class__.instances.append(weakref.ref(self, Log._on_dead))
+        self._write = gdb.write
 
-    def stop(self):
+    def setMessage(self, mess, exprs, compiled=None):
         """
-        Do not stop (always return false) and store log entry in log file
+        Set the message template and expressions, along with the fields derived from them
         """
-        global logFile
-        if not logFile or logFile == "none":
+        if compiled is None:
+            compiled = Log.compileMessage(mess, exprs)
+        self.mMess = mess
+        self.mExprs = exprs
+        (self.mMessParts, self.mMessPartsB, self.mEvalExprs) = compiled
+
+    def stop(self, _getFd=_get_log_fd, _flush=_flush_log_buf, _now=time.monotonic):
+        """
+        Do not stop (always return false) and store log entry in log file.
+        The default arguments bind the module helpers as locals for the hot path,
+        the buffer itself is looked up each time since re-sourcing replaces it
+        """
+        if logFile is _NONE or not logFile:
             return False
         # generate log message
-        outStr = Log.generateLog(self.mMess, self.mExprs)
         if logFile == "stdout":
-            gdb.write(outStr)
+            self._write(Log.generateLog(self.mMessParts, self.mEvalExprs))
         else:
-            with open(logFile, 'a') as openedFileForAppend:
-                openedFileForAppend.write(outStr + '\n')
+            _getFd(logFile)
+            buf = _logBuf
+            Log.appendLog(buf, self.mMessPartsB, self.mEvalExprs)
+            if len(buf) >= _LOG_BUF_MAX or _now() - _lastFlush >= _LOG_FLUSH_INTERVAL:
+                _flush()
         return False
 
+# logs restored from a previous load are recompiled, their compiled expressions
+# may not match what this version of generateLog and appendLog expect
+def _recompile_restored_logs():
+    for ref in Log.instances:
+        log = ref()
+        if (log is not None) and hasattr(log, 'mMess'):
+            Log.setMessage(log, log.mMess, log.mExprs)
+
+_recompile_restored_logs()
+
 class TestLog(gdb.Command):
     """Tests the log generation with the given message at the current frame"""
     def __init__(self):
@@ -182,19 +421,33 @@ class TestLog(gdb.Command):
         if nargs < 1:
             raise Exception("Not enough arguments")
         mess = args[0]
-        if mess.count("{}") is not (nargs - 1):
+        placeholders = mess.count("{}")
+        if placeholders != nargs - 1:
             raise Exception("Invalid message format")
         exprs = args[1:]
         # generate log message
-        outStr = Log.generateLog(mess, exprs)
+        outStr = Log.generateLog(Log.splitMessage(mess), Log.compileExprs(exprs))
         # print to stdout regardless
         gdb.write(outStr)
         global logFile
         if logFile and not (logFile == "none") and not (logFile == "stdout"):
-            with open(logFile, 'a') as openedFileForAppend:
-                openedFileForAppend.write(outStr + '\n')
+            _get_log_fd(logFile)
+            _logBuf.extend(outStr.encode())
+            _logBuf.extend(b'\n')
+            _flush_log_buf()
 
-TestLog()
+class FlushLogs(gdb.Command):
+    """Write any buffered log entries to the log file and sync it to disk"""
+    def __init__(self):
+        super(FlushLogs, self).__init__("flushlogs", gdb.COMMAND_USER)
+
+    def invoke(self, arg, from_tty):
+        if arg:
+            raise Exception("This command takes no arguments")
+        _flush_log_buf()
+        _drain_queue()
+        if _logFd is not None:
+            os.fsync(_logFd)
 
 class AddLog(gdb.Command):
     """Add log entry at spec with the given message"""
@@ -211,14 +464,14 @@ class AddLog(gdb.Command):
             raise Exception("Not enough arguments")
         spec = args[0]
         mess = args[1]
-        if mess.count("{}") is not (nargs - 2):
+        placeholders = mess.count("{}")
+        if placeholders != nargs - 2:
             raise Exception("Invalid message format")
-        kwargs = {}
-        log = Log(spec, **kwargs)
-        log.mMess = mess
-        log.mExprs = args[2:]
+        log = Log(spec)
+        log.setMessage(mess, args[2:])
 
-AddLog()
+# breakpoint definitions as written by "save breakpoints"
+_BREAK = b'break '
 
 class ImportLogs(gdb.Command):
     """Import log definitions from the given file argument (as exported by the exportlogs command). 
@@ -234,27 +487,38 @@ class ImportLogs(gdb.Command):
         filename = args[0]
         if not os.path.isfile(filename):
             raise Exception("First argument is not a valid file path or file does not exist")
-        kwargs = {}
         if nargs == 1:
             # import from log definitions
             gdb.execute("source {}".format(filename))
         else:
             # import from breakpoint definitions
-            sizeOfToken = len("break ")
+            sizeOfToken = len(_BREAK)
             mess = args[1]
             exprs = args[2:]
-            with open(filename) as file:
+            # same message for every imported location, validate once
+            placeholders = mess.count("{}")
+            if placeholders != nargs - 2:
+                raise Exception("Invalid message format")
+            compiled = Log.compileMessage(mess, exprs)
+            specs = {}
+            with open(filename, 'rb') as file:
                 for line in file:
-                    breakDef = line.rstrip()
-                    if not breakDef.startswith("break "):
+                    if not line.startswith(_BREAK):
                         continue
-                    spec = breakDef[sizeOfToken:]                    
-                    log = Log(spec, **kwargs)
-                    log.mMess = mess
-                    log.mExprs = exprs
-
+                    # decode just the location, not the whole line
+                    spec = line[sizeOfToken:].rstrip().decode('utf-8', 'replace')
+                    if spec in specs:
+                        gdb.write("Skipping duplicate location {}\n".format(spec))
+                        continue
+                    specs[spec] = None
+            # group locations of the same file together,
+            # so consecutive logs resolve against the same symtab
+            specs = sorted(specs)
+            _Log = Log
+            for spec in specs:
+                log = _Log(spec, internal=True)
+                log.setMessage(mess, exprs, compiled)
 
-ImportLogs()
 
 class ExportLogs(gdb.Command):
     """Export log definitions to a file that can be used later with the importlogs command"""
@@ -265,15 +529,18 @@ class ExportLogs(gdb.Command):
         if not arg:
             raise Exception("Missing arguments")
         filename = arg
-        Path(filename).touch(mode=0o666, exist_ok=True)
-        with open(filename, 'a') as openedFileForAppend:            
-            for log in Log.instances:
-                openedFileForAppend.write("addlog {} \"{}\"".format(log.location, log.mMess))
-                for expr in log.mExprs:
-                    openedFileForAppend.write(" \"{}\"".format(expr))
-                openedFileForAppend.write('\n')
-
-ExportLogs()
+        # serialize everything first, then write it out at once
+        lines = []
+        for ref in Log.instances:
+            log = ref()
+            if log is None:
+                continue
+            parts = ['addlog ', log.location, ' "', log.mMess, '"']
+            parts.extend(' "%s"' % e for e in log.mExprs)
+            parts.append('\n')
+            lines.append(''.join(parts))
+        with open(filename, 'w') as openedFile:
+            openedFile.writelines(lines)
 
 class ListLogs(gdb.Command):
     """List log definitions"""
@@ -286,14 +553,12 @@ class ListLogs(gdb.Command):
         if len(Log.instances) == 0:
             gdb.write("No log definitions")
             return
-        gdb.write("Num   Location   Message\n")
-        for i, log in enumerate(Log.instances):
-            try:
-                gdb.write("{}      {}    {}\n".format(i, log.location, log.mMess))
-            except ReferenceError:
-                pass
-
-ListLogs()
+        gdb.write("Num   Enb   Location   Message\n")
+        for i, ref in enumerate(Log.instances):
+            log = ref()
+            if log is None:
+                continue
+            gdb.write("{}      {}     {}    {}\n".format(i, "y" if log.enabled else "n", log.location, log.mMess))
 
 class RmLog(gdb.Command):
     """Remove log definition by index (from listlogs list)"""
@@ -303,14 +568,80 @@ class RmLog(gdb.Command):
     def invoke(self, arg, from_tty):
         # delete all if no args
         if not arg:
-            for log in Log.instances:
-                log.delete()
-            Log.instances = []
+            # logs are internal breakpoints, which "delete breakpoints" does not
+            # remove, so they have to be deleted one by one
+            inst = Log.instances
+            _delete = gdb.Breakpoint.delete
+            # iterate a copy, deleted logs drop out of the list as they are collected
+            for ref in list(inst):
+                log = ref()
+                if log is None:
+                    continue
+                _delete(log)
+            inst.clear()
             return
         i = int(arg)
         if i < 0 or i >= len(Log.instances):
             raise Exception("Log index out of bounds")
-        toRemove = Log.instances[i]
-        toRemove.delete()
+        ref = Log.instances[i]
+        toRemove = ref()
+        if toRemove is not None:
+            toRemove.delete()
+        try:
+            Log.instances.remove(ref)
+        except ValueError:
+            pass
+
+def _set_log_enabled(arg, enabled):
+    if not arg:
+        raise Exception("Missing arguments")
+    i = int(arg)
+    if i < 0 or i >= len(Log.instances):
+        raise Exception("Log index out of bounds")
+    log = Log.instances[i]()
+    if log is not None:
+        # a disabled breakpoint is never hit, so its expressions are not evaluated
+        log.enabled = enabled
+
+class EnableLog(gdb.Command):
+    """Enable log definition by index (from listlogs list)"""
+    def __init__(self):
+        super(EnableLog, self).__init__("enablelog", gdb.COMMAND_USER)
+
+    def invoke(self, arg, from_tty):
+        _set_log_enabled(arg, True)
 
-RmLog()
\ No newline at end of file
+class DisableLog(gdb.Command):
+    """Disable log definition by index (from listlogs list), it is kept and can be enabled again"""
+    def __init__(self):
+        super(DisableLog, self).__init__("disablelog", gdb.COMMAND_USER)
+
+    def invoke(self, arg, from_tty):
+        _set_log_enabled(arg, False)
+
+# commands are registered right away rather than on the first prompt, so that
+# they can be used by the same script or gdbinit that sources this file
+_COMMANDS = [
+    LogFile,
+    LogFileAsync,
+    GetThreadName,
+    GetLocSpec,
+    GetSimpleBt,
+    GetFormatTime,
+    SubprocExec,
+    TestLog,
+    FlushLogs,
+    AddLog,
+    ImportLogs,
+    ExportLogs,
+    ListLogs,
+    RmLog,
+    EnableLog,
+    DisableLog,
+]
+
+def _register_commands():
+    for command in _COMMANDS:
+        command()
+
+_register_commands()